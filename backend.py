@@ -1,9 +1,19 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
+import atexit
+import mmap
+import orjson
+import queue
+import secrets
+import shutil
 import sqlite3
+import time
 import mimetypes
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 import os
+from werkzeug.exceptions import NotFound
 from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
@@ -11,11 +21,230 @@ CORS(app)
 
 # ----------------- Config -----------------
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100 MB
+# Cap how much of a multipart form Werkzeug keeps in RAM; bigger parts
+# spool to a temp file instead of pinning memory per request.
+app.config['MAX_FORM_MEMORY_SIZE'] = 1 * 1024 * 1024
 UPLOAD_FOLDER = 'uploads'
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB copy buffer for streaming saves
+
+# When running behind nginx, set USE_X_ACCEL=1 and configure
+#   location /protected/ { internal; sendfile on; tcp_nopush on; alias <abs path to uploads>/; }
+# so nginx serves the bytes via kernel sendfile() and the Python worker
+# only emits headers.
+USE_X_ACCEL = os.environ.get("USE_X_ACCEL") == "1"
+
+# Allowed upload extensions, keyed by the type we store for them.
+IMAGE_EXTS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'})
+VIDEO_EXTS = frozenset({'.mp4', '.mov', '.avi', '.mkv', '.flv', '.wmv'})
+ALLOWED_EXTS = IMAGE_EXTS | VIDEO_EXTS
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 DB_NAME = 'uploads.db'
 
+# PRAGMAs applied to every connection: WAL lets readers run alongside the
+# writer, NORMAL sync skips the per-commit full fsync (safe under WAL),
+# and the rest trade a little memory for fewer disk hits.
+CONNECTION_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-8000;
+PRAGMA mmap_size=268435456;
+PRAGMA busy_timeout=5000;
+"""
+
+def get_conn():
+    """Open a connection to the uploads DB with the tuned PRAGMAs applied."""
+    conn = sqlite3.connect(DB_NAME, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(CONNECTION_PRAGMAS)
+    return conn
+
+# Hot-path SQL, defined once instead of rebuilt per request.
+SQL_LIST = """
+SELECT id, filename, file_type, geotag, time_sent, created_at
+FROM uploads
+WHERE file_type IN ('image', 'video')
+ORDER BY created_at DESC
+LIMIT ? OFFSET ?
+"""
+SQL_GET_PATH = "SELECT file_path FROM uploads WHERE id=?"
+
+class SqliteConnPool:
+    """Small pool of read connections reused across requests.
+
+    Opening a SQLite connection per request means re-opening the .db,
+    .db-wal and .db-shm files and re-running the PRAGMAs every time;
+    keeping a handful of long-lived connections avoids all of that.
+    Connections are created lazily, up to `size`, and handed out to
+    whichever thread asks — the same open/close saving a per-thread
+    connection stash would give, without pinning one connection per
+    worker thread.
+    """
+
+    def __init__(self, size=8):
+        self._size = size
+        self._created = 0
+        self._lock = threading.Lock()
+        self._idle = queue.Queue()
+        self._all = []
+
+    @contextmanager
+    def borrow(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if self._created < self._size:
+                    self._created += 1
+                    conn = get_conn()
+                    self._all.append(conn)
+                else:
+                    conn = None
+            if conn is None:
+                conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close_all(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+            self._created = 0
+
+# Read connections come from the pool; all writes go through a single
+# dedicated connection serialized by write_lock (SQLite allows only one
+# writer at a time anyway, so queueing in-process beats busy-waiting).
+pool = SqliteConnPool(size=8)
+write_conn = get_conn()
+# Let the WAL grow to ~1000 pages before checkpointing so write bursts
+# aren't interrupted mid-stream; /checkpoint can force a truncate.
+write_conn.execute("PRAGMA wal_autocheckpoint=1000")
+write_lock = threading.Lock()
+
+# The /uploads listing only changes when a write lands, so serialized
+# responses are reused for a short window. _data_version is bumped on
+# every committed write; a cached body is served only while both the
+# version matches and the TTL has not elapsed.
+_data_version = 0
+_uploads_cache = {}  # (host, limit, offset) -> (version, built_at, payload)
+UPLOADS_CACHE_TTL = 1.0  # seconds
+
+class _PendingWrite:
+    """One queued INSERT; the submitting thread waits on `done`."""
+    __slots__ = ('sql', 'params', 'done', 'last_id', 'error')
+
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+        self.done = threading.Event()
+        self.last_id = None
+        self.error = None
+
+_write_queue = queue.Queue()
+WRITE_BATCH_MAX = 64
+
+def _write_batch(batch):
+    """Commit one batch of queued INSERTs on the write connection,
+    recording per-op results/errors. Never raises."""
+    global _data_version
+    with write_lock:
+        try:
+            write_conn.execute("BEGIN IMMEDIATE")
+            for op in batch:
+                try:
+                    op.last_id = write_conn.execute(op.sql, op.params).lastrowid
+                except Exception as exc:
+                    op.error = exc
+            write_conn.execute("COMMIT")
+        except Exception as exc:
+            # BEGIN itself may have failed (e.g. 'database is locked'
+            # past busy_timeout with multiple worker processes), in
+            # which case there is no transaction to roll back.
+            try:
+                write_conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            for op in batch:
+                if op.error is None:
+                    op.error = exc
+        _data_version += 1
+
+def _writer_loop():
+    """Dedicated writer: drains queued INSERTs and commits them in one
+    transaction per batch, so concurrent uploads share a single WAL
+    fsync instead of paying one each."""
+    while True:
+        batch = [_write_queue.get()]
+        while len(batch) < WRITE_BATCH_MAX:
+            try:
+                batch.append(_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _write_batch(batch)
+        except Exception as exc:
+            for op in batch:
+                if op.error is None:
+                    op.error = exc
+        finally:
+            # Waiters must always be released, or their requests hang.
+            for op in batch:
+                op.done.set()
+
+_writer_thread = threading.Thread(target=_writer_loop, name='db-writer', daemon=True)
+_writer_thread.start()
+
+WRITE_WAIT_TIMEOUT = 30.0  # backstop so a wedged writer can't hang requests forever
+
+def db_write(sql, params):
+    """Queue one INSERT for the writer thread, wait for its commit and
+    return the new rowid. Raises whatever the INSERT raised."""
+    op = _PendingWrite(sql, params)
+    _write_queue.put(op)
+    if not op.done.wait(WRITE_WAIT_TIMEOUT):
+        raise sqlite3.OperationalError("timed out waiting for database write")
+    if op.error is not None:
+        raise op.error
+    return op.last_id
+
+def _close_connections():
+    # Give the writer thread a moment to drain anything still queued
+    # before its connection goes away.
+    deadline = time.time() + 5.0
+    while not _write_queue.empty() and time.time() < deadline:
+        time.sleep(0.01)
+    pool.close_all()
+    write_conn.close()
+
+atexit.register(_close_connections)
+
+def _iter_mmap(mm):
+    """Yield a memory-mapped file in copy-buffer-sized chunks, closing
+    the mapping once the response is exhausted or abandoned."""
+    try:
+        pos = 0
+        size = len(mm)
+        while pos < size:
+            yield mm[pos:pos + UPLOAD_CHUNK_SIZE]
+            pos += UPLOAD_CHUNK_SIZE
+    finally:
+        mm.close()
+
+def save_upload_stream(stream, file_path):
+    """Stream an incoming upload to `file_path` in fixed-size chunks.
+
+    Portable write path: an unbuffered handle plus a 1 MiB copy buffer
+    keeps the kernel page cache doing the batching. If this ever becomes
+    the bottleneck on NVMe, an io_uring-based writer could slot in here
+    behind the same signature.
+    """
+    with open(file_path, 'wb', buffering=0) as out:
+        shutil.copyfileobj(stream, out, length=UPLOAD_CHUNK_SIZE)
+
 # Expected schema (column name -> SQL type/constraint)
 EXPECTED_COLUMNS = {
     "id": "INTEGER PRIMARY KEY AUTOINCREMENT",
@@ -57,6 +286,31 @@ def ensure_schema(conn):
             cur.execute(f"ALTER TABLE uploads ADD COLUMN {col} {coldef}")
     conn.commit()
 
+def migrate_blobs_to_disk(conn):
+    """One-shot migration for DBs created by the old BLOB-storing variant.
+
+    Writes each file_data blob out to the upload folder, points file_path
+    at it, then rebuilds the table without the column so metadata rows go
+    back to fitting in ordinary pages instead of straddling overflow
+    pages sized by the media itself.
+    """
+    cur = conn.cursor()
+    for row_id, filename, blob in cur.execute(
+            "SELECT id, filename, file_data FROM uploads WHERE file_data IS NOT NULL"):
+        file_path = os.path.join(UPLOAD_FOLDER, f"{row_id}_{filename}")
+        with open(file_path, 'wb') as out:
+            out.write(blob)
+        conn.execute("UPDATE uploads SET file_path=? WHERE id=?", (file_path, row_id))
+
+    columns = ", ".join(EXPECTED_COLUMNS)
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute("ALTER TABLE uploads RENAME TO uploads_old")
+    conn.execute(CREATE_TABLE_SQL)
+    conn.execute(f"INSERT INTO uploads ({columns}) SELECT {columns} FROM uploads_old")
+    conn.execute("DROP TABLE uploads_old")
+    conn.execute("COMMIT")
+    conn.execute("VACUUM")
+
 def reset_schema(conn):
     """Drop and recreate the uploads table (destructive)."""
     cur = conn.cursor()
@@ -69,12 +323,28 @@ def reset_schema(conn):
 def init_db():
     reset_requested = os.environ.get("RESET_DB") == "1"
 
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_conn()
     try:
+        # WAL mode is persistent, but verify it actually took effect so a
+        # misconfigured filesystem (e.g. one without shared-memory support)
+        # fails loudly at startup instead of silently running in DELETE mode.
+        mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if mode != "wal":
+            raise RuntimeError(f"Could not enable WAL journal mode (got {mode!r})")
+
         if reset_requested:
             reset_schema(conn)
         else:
             ensure_schema(conn)
+            if "file_data" in table_columns(conn, "uploads"):
+                migrate_blobs_to_disk(conn)
+
+        # Covering index for the listing query (newest first). Keeps
+        # /uploads reading only the page it returns instead of scanning
+        # the whole table as it grows.
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_uploads_created ON uploads(created_at DESC, id)"
+        )
     finally:
         conn.close()
 
@@ -85,6 +355,12 @@ init_db()
 # POST /upload → Upload image or video
 @app.route('/upload', methods=['POST'])
 def upload_file():
+    # Reject oversize requests from the declared Content-Length alone,
+    # before touching request.files (which parses the whole body).
+    content_length = request.content_length
+    if content_length is not None and content_length > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'error': 'File too large'}), 413
+
     if 'file' not in request.files:
         return jsonify({'error': 'No file found in request'}), 400
 
@@ -95,44 +371,43 @@ def upload_file():
     # Sanitize filename
     filename = secure_filename(uploaded_file.filename)
 
-    # Allowed extensions
-    allowed_exts = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp',
-                    '.mp4', '.mov', '.avi', '.mkv', '.flv', '.wmv')
-    if not filename.lower().endswith(allowed_exts):
+    # Classify by extension up front so bad uploads are rejected before
+    # anything is written to disk.
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in ALLOWED_EXTS:
         return jsonify({'error': 'File type not allowed'}), 400
+    file_type = 'video' if ext in VIDEO_EXTS else 'image'
+
+    # Prefix with a unique token: a per-second timestamp collides (and
+    # silently overwrites) under concurrent uploads, and strftime is
+    # needlessly expensive here.
+    rand = secrets.token_hex(4)
+    token = f"{time.time_ns():x}_{rand}"
+    stored_name = f"{token}_{filename}"
+
+    # Shard into 256 buckets off the random part so no single directory
+    # accumulates enough entries to slow down lookups.
+    bucket_dir = os.path.join(UPLOAD_FOLDER, rand[:2])
+    os.makedirs(bucket_dir, exist_ok=True)
+    file_path = os.path.join(bucket_dir, stored_name)
 
-    # Save file to disk with timestamp
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    timestamped_name = f"{timestamp}_{filename}"
-    file_path = os.path.join(UPLOAD_FOLDER, timestamped_name)
-    uploaded_file.save(file_path)
-
-    # Detect MIME type
-    mime_type, _ = mimetypes.guess_type(file_path)
-    if mime_type and mime_type.startswith("video"):
-        file_type = "video"
-    elif mime_type and mime_type.startswith("image"):
-        file_type = "image"
-    else:
-        os.remove(file_path)  # delete invalid file
-        return jsonify({'error': 'Invalid file type'}), 400
+    # Stream to disk in fixed-size chunks: peak memory stays at one
+    # buffer regardless of file size, instead of the whole upload.
+    save_upload_stream(uploaded_file.stream, file_path)
 
     geotag = request.form.get('geotag', 'Not provided')
     time_sent = request.form.get('time', 'Not provided')
+    # host_url rebuilds the URL from headers on every access; read it once.
+    host_url = request.host_url
 
     # Save metadata to DB
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute(
+    last_id = db_write(
         '''
         INSERT INTO uploads (filename, file_type, file_path, geotag, time_sent)
         VALUES (?, ?, ?, ?, ?)
         ''',
         (filename, file_type, file_path, geotag, time_sent)
     )
-    conn.commit()
-    last_id = c.lastrowid
-    conn.close()
 
     return jsonify({
         'message': f'{file_type.capitalize()} uploaded successfully',
@@ -141,7 +416,7 @@ def upload_file():
         'file_type': file_type,
         'geotag': geotag,
         'time_sent': time_sent,
-        'file_url': f"{request.host_url}file/{last_id}"
+        'file_url': host_url + 'file/' + str(last_id)
     }), 200
 
 
@@ -156,18 +431,13 @@ def save_location():
     longitude = data["longitude"]
 
     # Save location to DB (optional)
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute(
+    last_id = db_write(
         '''
         INSERT INTO uploads (filename, file_type, file_path, geotag, time_sent)
         VALUES (?, ?, ?, ?, ?)
         ''',
         ("location", "location", "N/A", f"{latitude},{longitude}", datetime.now().isoformat())
     )
-    conn.commit()
-    last_id = c.lastrowid
-    conn.close()
 
     return jsonify({
         "message": "Location saved successfully",
@@ -177,58 +447,137 @@ def save_location():
     }), 200
 
 
-# GET /uploads → List all uploads
+# GET /uploads → List uploads, newest first (?limit=&offset= to paginate)
 @app.route('/uploads', methods=['GET'])
 def get_uploads():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT id, filename, file_type, geotag, time_sent, created_at FROM uploads')
-    rows = c.fetchall()
-    conn.close()
-
-    uploads_list = [{
-        'id': r[0],
-        'filename': r[1],
-        'file_type': r[2],
-        'geotag': r[3],
-        'time_sent': r[4],
-        'created_at': r[5],
-        'file_url': f"{request.host_url}file/{r[0]}"
-    } for r in rows]
-
-    return jsonify({'uploads': uploads_list}), 200
+    limit = request.args.get('limit', default=100, type=int)
+    offset = request.args.get('offset', default=0, type=int)
+    limit = max(1, min(limit, 500))
+    offset = max(0, offset)
+
+    cache_key = (request.host_url, limit, offset)
+    cached = _uploads_cache.get(cache_key)
+    if cached and cached[0] == _data_version and time.time() - cached[1] < UPLOADS_CACHE_TTL:
+        return app.response_class(cached[2], mimetype='application/json'), 200
+
+    with pool.borrow() as conn:
+        c = conn.execute(SQL_LIST, (limit, offset))
+        c.arraysize = limit
+        file_url_prefix = request.host_url + 'file/'
+        uploads_list = [{
+            'id': r['id'],
+            'filename': r['filename'],
+            'file_type': r['file_type'],
+            'geotag': r['geotag'],
+            'time_sent': r['time_sent'],
+            'created_at': r['created_at'],
+            'file_url': file_url_prefix + str(r['id'])
+        } for r in c]
+
+    # orjson serializes the whole payload in C, several times faster
+    # than the stdlib encoder jsonify goes through.
+    payload = orjson.dumps({'uploads': uploads_list})
+
+    if len(_uploads_cache) > 32:  # keep odd one-off pagination keys from piling up
+        _uploads_cache.clear()
+    _uploads_cache[cache_key] = (_data_version, time.time(), payload)
+
+    return app.response_class(payload, mimetype='application/json'), 200
 
 # GET /file/<id> → Retrieve a single file
 @app.route("/file/<int:file_id>", methods=["GET"])
 def get_file(file_id):
     try:
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        # Fetch the actual saved path
-        c.execute("SELECT file_path FROM uploads WHERE id=?", (file_id,))
-        row = c.fetchone()
-        conn.close()
+        with pool.borrow() as conn:
+            # Fetch the actual saved path
+            row = conn.execute(SQL_GET_PATH, (file_id,)).fetchone()
 
         if row is None:
             return jsonify({"error": f"file not found with id {file_id}"}), 404
 
-        file_path = row[0]
-
-        if not os.path.exists(file_path):
+        file_path = row['file_path']
+
+        # Path relative to the upload root (handles both sharded
+        # bucket/name paths and pre-shard flat ones).
+        rel_path = os.path.relpath(file_path, UPLOAD_FOLDER)
+
+        if USE_X_ACCEL:
+            mime_type = mimetypes.guess_type(rel_path)[0] or 'application/octet-stream'
+            resp = app.response_class(status=200, mimetype=mime_type)
+            resp.headers['X-Accel-Redirect'] = '/protected/' + rel_path
+            return resp
+
+        # Without wsgi.file_wrapper (dev server, some embedded setups)
+        # send_file degrades to a Python read() loop; mmap the file and
+        # stream slices instead, letting the kernel demand-page as the
+        # socket drains.
+        if request.environ.get('wsgi.file_wrapper') is None:
+            try:
+                f = open(os.path.join(UPLOAD_FOLDER, rel_path), 'rb')
+            except FileNotFoundError:
+                return jsonify({"error": "File not found on server"}), 404
+            with f:
+                st = os.fstat(f.fileno())
+                try:
+                    mm = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+                except ValueError:
+                    mm = None  # empty file can't be mapped; fall through
+            if mm is not None:
+                # No stream_with_context: the iterator only reads the
+                # mapping, and a context-bound generator misbehaves when
+                # make_conditional swaps it out for a 304 or range body.
+                mime_type = mimetypes.guess_type(rel_path)[0] or 'application/octet-stream'
+                resp = app.response_class(_iter_mmap(mm), mimetype=mime_type)
+                resp.headers['Content-Length'] = str(len(mm))
+                # Same validators as the sendfile path below, so 304s
+                # and Range requests keep working without file_wrapper
+                # (make_conditional's range wrapper slices the iterator).
+                resp.set_etag(f"{st.st_size}-{st.st_mtime_ns:x}")
+                resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+                return resp.make_conditional(request, accept_ranges=True,
+                                             complete_length=st.st_size)
+
+        # send_from_directory keeps the response backed by a real file
+        # object, so WSGI servers that honor wsgi.file_wrapper can use
+        # kernel sendfile() instead of a userspace read/write loop. It
+        # raises NotFound itself for missing files, so no separate
+        # os.path.exists stat() on the hot path.
+        try:
+            resp = send_from_directory(UPLOAD_FOLDER, rel_path, conditional=False)
+        except NotFound:
             return jsonify({"error": "File not found on server"}), 404
 
-        return send_file(file_path)
+        # Uploads are immutable, so a (size, mtime) ETag is stable and a
+        # long-lived Cache-Control lets browsers/CDNs skip the re-download
+        # entirely; make_conditional turns validator hits into 304s.
+        st = os.stat(file_path)
+        resp.set_etag(f"{st.st_size}-{st.st_mtime_ns:x}")
+        resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return resp.make_conditional(request, accept_ranges=True,
+                                     complete_length=st.st_size)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# POST /checkpoint → Admin: fold the WAL back into the main DB file
+@app.route("/checkpoint", methods=["POST"])
+def checkpoint():
+    with write_lock:
+        busy, log_pages, moved = write_conn.execute(
+            "PRAGMA wal_checkpoint(TRUNCATE)"
+        ).fetchone()
+    return jsonify({"busy": busy, "log_pages": log_pages, "checkpointed": moved}), 200
+
 # ----------------- Root Route -----------------
 @app.route("/", methods=["GET"])
 def home():
     return "Backend is running successfully 🚀"
 
 # ----------------- Run Server -----------------
-if __name__ == '__main__':
+# Production runs under gunicorn (see Procfile); the Werkzeug dev server
+# is single-threaded, bypasses wsgi.file_wrapper (no sendfile) and must
+# never ship with the debugger on. Opt in locally with DEV=1.
+if __name__ == '__main__' and os.environ.get("DEV") == "1":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=True)
 